@@ -1,24 +1,34 @@
 import asyncio
 import aiohttp
-import pymelcloud
+import hashlib
 import os
-import json
-import traceback
+import re
+import orjson
 import time
 from datetime import datetime
-from zoneinfo import ZoneInfo
 
 # --- CONFIGURACIÓN ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATE_FILE = os.path.join(BASE_DIR, "estado_melcloud.json")
 LAST_ACTION_FILE = os.path.join(BASE_DIR, "ultima_accion.json")
-TZ_SPAIN = ZoneInfo("Europe/Madrid")
+WEATHER_CACHE_FILE = os.path.join(BASE_DIR, "weather_cache.json")
+TOKEN_FILE = os.path.join(BASE_DIR, "melcloud_token.json")
+# Hora local del proceso en Madrid: log(), el CSV y el horario de calefacción la usan sin zoneinfo
+os.environ["TZ"] = "Europe/Madrid"
+time.tzset()
+# Sin base de datos de zonas tzset() cae a UTC en silencio: mejor fallar que encender a deshora
+if time.tzname != ("CET", "CEST"):
+    raise RuntimeError(f"Zona horaria Europe/Madrid no disponible (tzname={time.tzname}); instala tzdata")
 
 # PARÁMETROS DE CONTROL ACTUALIZADOS
 UMBRAL_SEGURIDAD_FRIO = -2.0  # Bajado de 5.0 a -2.0 para que apoyen a la caldera en frío
 UMBRAL_BUEN_TIEMPO_INVIERNO = 19.0 
 UMBRAL_CORTE_VERANO = 22.0 
 DURACION_BLOQUEO_MANUAL = 3600
+# Open-Meteo refresca "current_weather" cada 15 min. Con ciclos cada ~20 min la caché casi nunca
+# acierta; solo ahorra llamadas en ejecuciones extra (manuales). En el ciclo normal ayuda el 304
+WEATHER_CACHE_TTL = 15 * 60
+TOKEN_TTL = 12 * 3600  # El token de MELCloud dura bastante más; renovamos con margen
 
 # CONFIGURACIÓN DE TEMPERATURAS PARA EQUILIBRAR ARRIBA/ABAJO
 # Bajamos un poco arriba para que el calor no se acumule allí y el salón trabaje más
@@ -37,41 +47,135 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHAT_ID = os.getenv("CHAT_ID")
 LAT, LON = 41.6596, -4.7454
 
+CSV_PATH = os.path.join(BASE_DIR, "historico_calefaccion.csv")
+CSV_HEADER = b"fecha,temp_ext,salon_on,dorm_on,jimena_on,elisa_on\n"
+# Diario de filas pendientes de volcar al CSV. Es estado del bot igual que el CSV y los JSON:
+# debe persistirse entre ejecuciones junto a ellos (si no, las filas pendientes se pierden)
+HISTORY_JOURNAL_FILE = os.path.join(BASE_DIR, "historico.jsonl")
+# Diario apartado mientras se vuelca; solo existe si un volcado se interrumpió
+HISTORY_ROLLUP_FILE = HISTORY_JOURNAL_FILE + ".rollup"
+CSV_ROLLUP_EVERY = 3  # Ciclos cada ~20 min: volcamos el diario al CSV aproximadamente cada hora
+
+def volcar_historico_csv():
+    # Vuelca al CSV el diario apartado en HISTORY_ROLLUP_FILE y lo borra
+    with open(HISTORY_ROLLUP_FILE, "rb") as f:
+        filas = f.read().splitlines()
+    lineas = b"".join(",".join(str(v) for v in orjson.loads(fila)).encode("utf-8") + b"\n" for fila in filas)
+
+    with open(CSV_PATH, "a+b", buffering=65536) as f:
+        size = f.seek(0, os.SEEK_END)
+        # Si el proceso murió tras escribir en el CSV pero antes de borrar el .rollup,
+        # las filas ya están al final del CSV: no las duplicamos
+        if size >= len(lineas):
+            f.seek(size - len(lineas))
+            ya_volcado = f.read() == lineas
+        else:
+            ya_volcado = False
+        if not ya_volcado:
+            # Una sola escritura por volcado (cabecera incluida si el fichero es nuevo)
+            f.write(lineas if size else CSV_HEADER + lineas)
+    os.remove(HISTORY_ROLLUP_FILE)
+
 def guardar_resumen_csv(temp_ext, devices):
-    path_csv = os.path.join(BASE_DIR, "historico_calefaccion.csv")
-    file_exists = os.path.exists(path_csv)
-    
-    with open(path_csv, "a", encoding="utf-8") as f:
-        if not file_exists:
-            f.write("fecha,temp_ext,salon_on,dorm_on,jimena_on,elisa_on\n")
-        
-        # Creamos una lista de estados (1 si está ON, 0 si está OFF)
-        estados = {d.name: (1 if d.power else 0) for d in devices}
-        linea = f"{datetime.now(TZ_SPAIN).strftime('%Y-%m-%d %H:%M')},{temp_ext},"
-        linea += f"{estados.get('Salón',0)},{estados.get('Dormitorio',0)},{estados.get('Jimena',0)},{estados.get('Elisa',0)}\n"
-        f.write(linea)
+    # Si un volcado anterior se interrumpió, lo terminamos antes de seguir
+    if os.path.exists(HISTORY_ROLLUP_FILE):
+        volcar_historico_csv()
+
+    # Creamos una lista de estados (1 si está ON, 0 si está OFF)
+    estados = {d.name: (1 if d.power else 0) for d in devices}
+    fila = [time.strftime('%Y-%m-%d %H:%M'), temp_ext,
+            estados.get('Salón',0), estados.get('Dormitorio',0), estados.get('Jimena',0), estados.get('Elisa',0)]
+
+    # Cada ciclo solo añade una línea al diario; el CSV se actualiza por lotes
+    with open(HISTORY_JOURNAL_FILE, "a+b") as f:
+        f.write(orjson.dumps(fila) + b"\n")
+        f.seek(0)
+        pendientes = len(f.read().splitlines())
+
+    if pendientes >= CSV_ROLLUP_EVERY:
+        # Apartamos el diario antes de volcarlo para no duplicar filas si el proceso muere a medias
+        os.replace(HISTORY_JOURNAL_FILE, HISTORY_ROLLUP_FILE)
+        volcar_historico_csv()
 
 def log(msg):
-    ts = datetime.now(TZ_SPAIN).strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{ts}] {msg}", flush=True)
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}", flush=True)
 
 def load_json(path, default):
     if not os.path.exists(path):
         return default.copy()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     except Exception as e:
         log(f"❌ ERROR: Fallo leyendo {path}: {e}")
         return default.copy()
 
-def save_json(path, data):
+def save_json(path, data, privado=False):
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        # Formato compacto: estos ficheros solo los lee el propio bot
+        data_bytes = orjson.dumps(data)
+        tmp = path + ".tmp"
+        if privado:
+            # Credenciales: solo legibles por el propietario (también si el .tmp ya existía)
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            f = os.fdopen(fd, "wb", buffering=65536)
+        else:
+            f = open(tmp, "wb", buffering=65536)
+        with f:
+            f.write(data_bytes)
+        os.replace(tmp, path)
     except Exception as e:
         log(f"❌ ERROR: Fallo guardando {path}: {e}")
 
+def firma(data):
+    # Huella del contenido para saber si hace falta volver a escribir el fichero
+    return hashlib.blake2b(orjson.dumps(data, option=orjson.OPT_SORT_KEYS)).digest()
+
+async def fetch_weather(session):
+    # Corre en paralelo con MELCloud/Telegram: el disco va a un hilo para no bloquear el bucle
+    cache = await asyncio.to_thread(load_json, WEATHER_CACHE_FILE, {})
+    if cache.get("lat") != LAT or cache.get("lon") != LON:
+        cache = {}
+    if cache and time.time() - cache.get("ts", 0) < WEATHER_CACHE_TTL:
+        log(f"📡 Temp Exterior (caché): {cache['temp']}°C")
+        return float(cache["temp"])
+
+    url = f"https://api.open-meteo.com/v1/forecast?latitude={LAT}&longitude={LON}&current_weather=true"
+    headers = {"If-Modified-Since": cache["last_modified"]} if cache.get("last_modified") else None
+    async with session.get(url, headers=headers) as r:
+        if r.status == 304:
+            # Sin datos nuevos en Open-Meteo: reutilizamos el valor guardado
+            temp_ext = float(cache["temp"])
+            last_modified = cache["last_modified"]
+            log(f"📡 Temp Exterior (sin cambios): {temp_ext}°C")
+        else:
+            data = await r.json(loads=orjson.loads)
+            temp_ext = float(data["current_weather"]["temperature"])
+            last_modified = r.headers.get("Last-Modified")
+            log(f"📡 Temp Exterior: {temp_ext}°C")
+    await asyncio.to_thread(save_json, WEATHER_CACHE_FILE, {"ts": time.time(), "lat": LAT, "lon": LON, "temp": temp_ext, "last_modified": last_modified})
+    return temp_ext
+
+async def melcloud_login(session):
+    import pymelcloud  # Import diferido: arrastra bastante al arrancar
+    token = await pymelcloud.login(EMAIL, PASSWORD, session)
+    await asyncio.to_thread(save_json, TOKEN_FILE, {"token": token, "expires": time.time() + TOKEN_TTL}, privado=True)
+    return token
+
+async def get_melcloud_devices(session):
+    import pymelcloud
+    cache = await asyncio.to_thread(load_json, TOKEN_FILE, {})
+    token = cache.get("token")
+    if token and time.time() < cache.get("expires", 0):
+        try:
+            return (await pymelcloud.get_devices(token, session)).get("ata", [])
+        except aiohttp.ClientResponseError as e:
+            if e.status != 401: raise
+            log("🔑 Token MELCloud caducado, repitiendo login.")
+    token = await melcloud_login(session)
+    return (await pymelcloud.get_devices(token, session)).get("ata", [])
+
 async def enviar_telegram(session, msg, temp=None):
     if temp is not None:
         msg = f"{msg}\n\n🌡️ <b>Temp. exterior:</b> {temp}°C"
@@ -80,49 +184,148 @@ async def enviar_telegram(session, msg, temp=None):
     try:
         url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
         payload = {"chat_id": CHAT_ID, "text": msg, "parse_mode": "HTML"}
-        async with session.post(url, json=payload) as resp:
+        async with session.post(url, data=orjson.dumps(payload), headers={"Content-Type": "application/json"}) as resp:
             if resp.status == 200:
                 log("✅ TELEGRAM: Enviado correctamente.")
     except Exception as e:
         log(f"⚠️ TELEGRAM EXCEPTION: {e}")
 
-async def check_telegram_commands(session, registro, estados_previos, temp_ext, devices, es_invierno, en_horario):
-    if not BOT_TOKEN: return
+async def aviso_caldera(session, weather_task, es_invierno):
+    try:
+        temp_ext = await weather_task
+    except Exception:
+        return  # El error de clima ya lo registra main()
+    if es_invierno and temp_ext <= 1.0:
+        log("⚠️ AVISO: Temp baja detectada. Sugiriendo caldera a 73°C.")
+        await enviar_telegram(session, "⚠️ <b>ALERTA:</b> Menos de 1°C exterior. Sube la caldera a <b>73°C</b> manualmente.", temp_ext)
+
+async def cmd_reset(session, registro, estados_previos, temp_ext, devices, en_horario):
+    for dev_name in estados_previos: estados_previos[dev_name]["bloqueo_hasta"] = 0
+    await enviar_telegram(session, "✅ Bloqueos reseteados.", temp_ext)
+
+async def cmd_stop(session, registro, estados_previos, temp_ext, devices, en_horario):
+    registro["stop_mode"] = True
+    await enviar_telegram(session, "🛑 Modo STOP activado.", temp_ext)
+
+async def cmd_start(session, registro, estados_previos, temp_ext, devices, en_horario):
+    registro["stop_mode"] = False
+    await enviar_telegram(session, "▶️ Modo START activado.", temp_ext)
+
+async def cmd_info(session, registro, estados_previos, temp_ext, devices, en_horario):
+    txt = f"📊 <b>ESTADO</b>\nHorario: {'SI' if en_horario else 'NO'}\nSTOP: {registro.get('stop_mode')}\n"
+    for d in devices: txt += f"• {d.name}: {'ON' if d.power else 'OFF'} ({d.target_temperature}°C)\n"
+    await enviar_telegram(session, txt, temp_ext)
+
+COMMANDS = {
+    "reset": cmd_reset,
+    "stop": cmd_stop,
+    "start": cmd_start,
+    "info": cmd_info,
+}
+# "/info" o "/info@MiBot" al inicio del mensaje; "/startx" no coincide
+CMD_RE = re.compile(r"^\s*/(" + "|".join(COMMANDS) + r")\b", re.IGNORECASE)
+
+async def poll_telegram_updates(session, registro):
+    if not BOT_TOKEN: return []
     last_id = registro.get("last_telegram_update_id", 0)
     try:
         url = f"https://api.telegram.org/bot{BOT_TOKEN}/getUpdates"
-        params = {"offset": last_id + 1, "timeout": 5}
+        # Sondeo corto y solo mensajes: el resto de tipos de update se filtran en el servidor
+        params = {"offset": last_id + 1, "timeout": 0, "allowed_updates": '["message"]'}
         async with session.get(url, params=params) as resp:
             if resp.status == 200:
-                data = await resp.json()
-                for result in data.get("result", []):
-                    registro["last_telegram_update_id"] = result["update_id"]
-                    msg_text = result.get("message", {}).get("text", "").lower()
-                    if "/reset" in msg_text:
-                        for dev_name in estados_previos: estados_previos[dev_name]["bloqueo_hasta"] = 0
-                        await enviar_telegram(session, "✅ Bloqueos reseteados.", temp_ext)
-                    if "/stop" in msg_text:
-                        registro["stop_mode"] = True
-                        await enviar_telegram(session, "🛑 Modo STOP activado.", temp_ext)
-                    if "/start" in msg_text:
-                        registro["stop_mode"] = False
-                        await enviar_telegram(session, "▶️ Modo START activado.", temp_ext)
-                    if "/info" in msg_text:
-                        txt = f"📊 <b>ESTADO</b>\nHorario: {'SI' if en_horario else 'NO'}\nSTOP: {registro.get('stop_mode')}\n"
-                        for d in devices: txt += f"• {d.name}: {'ON' if d.power else 'OFF'} ({d.target_temperature}°C)\n"
-                        await enviar_telegram(session, txt, temp_ext)
+                data = await resp.json(loads=orjson.loads)
+                return data.get("result", [])
     except Exception as e: log(f"⚠️ Error Telegram: {e}")
+    return []
+
+async def check_telegram_commands(session, updates, registro, estados_previos, temp_ext, devices, es_invierno, en_horario):
+    try:
+        for result in updates:
+            registro["last_telegram_update_id"] = result["update_id"]
+            m = CMD_RE.match(result.get("message", {}).get("text", "") or "")
+            if not m: continue
+            await COMMANDS[m.group(1).lower()](session, registro, estados_previos, temp_ext, devices, en_horario)
+    except Exception as e: log(f"⚠️ Error Telegram: {e}")
+
+async def process_device(dev, ahora_ts, temp_ext, registro, estados_previos, es_invierno, en_horario, queued):
+    # Leemos una sola vez los atributos del equipo y de la memoria
+    name, power, tt = dev.name, dev.power, dev.target_temperature
+    target = TEMP_OBJETIVOS.get(name, DEFAULT_TEMP_AUTO)
+    # Recuperamos memoria
+    mem = estados_previos.get(name, {"power": power, "target_temperature": tt, "bloqueo_hasta": 0})
+    mem_power, mem_tt, bloqueo = mem["power"], mem["target_temperature"], mem["bloqueo_hasta"]
+
+    log(f"💠 {name}: Estado={power}, Temp={tt}°C | Obj={target}°C")
+
+    # Gestión de Bloqueo Manual
+    if (mem_power != power or mem_tt != tt):
+        if ahora_ts > bloqueo:
+            log(f"    ✋ MANUAL DETECTADO en {name}")
+            queued.append(f"✋ <b>CAMBIO MANUAL:</b> {name} a {tt}°C")
+            bloqueo = mem["bloqueo_hasta"] = ahora_ts + DURACION_BLOQUEO_MANUAL
+    
+    # Actualizamos memoria con el estado actual del dispositivo antes de decidir
+    mem["power"], mem["target_temperature"] = power, tt
+
+    if bloqueo > ahora_ts:
+        log(f"    ⏳ {name} en bloqueo manual.")
+        return name, mem, None
+
+    # --- MOTOR DE DECISIÓN ---
+    # Cada rama fija el estado deseado; solo se envía a MELCloud lo que difiera del actual
+    objetivo, accion = {}, None
+
+    if temp_ext < UMBRAL_SEGURIDAD_FRIO:
+        objetivo, accion = {"power": False}, f"❄️ <b>SEGURIDAD:</b> Apagado {name} por frío extremo"
+    
+    elif (not es_invierno) and (temp_ext < UMBRAL_CORTE_VERANO):
+        objetivo, accion = {"power": False}, f"☀️ <b>FRESCO:</b> Apagado {name}"
+
+    elif registro.get("stop_mode"):
+        objetivo, accion = {"power": False}, f"🛑 <b>STOP:</b> Apagado {name}"
+
+    else:
+        if es_invierno:
+            if not en_horario:
+                objetivo, accion = {"power": False}, f"🕒 <b>NOCHE:</b> Apagado {name}"
+            elif en_horario and temp_ext <= UMBRAL_BUEN_TIEMPO_INVIERNO:
+                objetivo, accion = {"power": True, "target_temperature": target}, f"🔥 <b>APOYO:</b> {name} a {target}°C"
+
+    actual = {"power": power, "target_temperature": tt}
+    desired = {k: v for k, v in objetivo.items() if actual[k] != v}
+    accion_tomada = None
+
+    if desired:
+        if desired.get("power", power):
+            # Si está apagado o la temperatura no es la correcta, actuamos (en modo calor)
+            log(f"    🔥 Ajustando {name} a {target}°C")
+            if dev.operation_mode != "heat":
+                desired["operation_mode"] = "heat"
+        # Una única llamada por equipo con todos los cambios
+        await dev.set(desired)
+        mem["power"] = desired.get("power", power)
+        mem["target_temperature"] = desired.get("target_temperature", tt)
+        accion_tomada = accion
+
+    if accion_tomada:
+        queued.append(accion_tomada)
+
+    return name, mem, accion_tomada
 
 async def main():
     log("🔊 === INICIO CICLO V8.3 (FUNCIONALIDAD COMPLETA + LOGS + HISTÓRICO) ===")
-    async with aiohttp.ClientSession() as session:
+    # Un único conector con keepalive para reutilizar TLS con MELCloud, Telegram y Open-Meteo
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=8, keepalive_timeout=75, ttl_dns_cache=300, enable_cleanup_closed=True)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30)) as session:
         registro = load_json(LAST_ACTION_FILE, {})
         estados_previos = load_json(STATE_FILE, {})
         
         if "last_telegram_update_id" not in registro: registro["last_telegram_update_id"] = 0
         if "stop_mode" not in registro: registro["stop_mode"] = False
+        firma_estados, firma_registro = firma(estados_previos), firma(registro)
 
-        ahora = datetime.now(TZ_SPAIN)
+        ahora = datetime.now()
         ahora_ts = time.time()
         minutos = ahora.hour * 60 + ahora.minute
         es_finde = ahora.weekday() >= 5
@@ -130,97 +333,64 @@ async def main():
         # Mantenemos tu horario de 6:30 a 23:00
         en_horario = (390 <= minutos < 1380)
 
-        # --- TEMPERATURA EXTERIOR ---
+        # Mensajes de Telegram del ciclo; se envían todos a la vez al final
+        queued = []
+        temp_ext = None
+
+        # --- TEMPERATURA EXTERIOR + TELEGRAM (en paralelo con MELCloud) ---
+        weather_task = asyncio.create_task(fetch_weather(session))
+        updates_task = asyncio.create_task(poll_telegram_updates(session, registro))
+        # El aviso de la caldera sale en cuanto hay temperatura, falle o no MELCloud
+        aviso_task = asyncio.create_task(aviso_caldera(session, weather_task, es_invierno))
+
         try:
-            url = f"https://api.open-meteo.com/v1/forecast?latitude={LAT}&longitude={LON}&current_weather=true"
-            async with session.get(url) as r:
-                data = await r.json()
-                temp_ext = float(data["current_weather"]["temperature"])
-                log(f"📡 Temp Exterior: {temp_ext}°C")
-        except Exception as e:
-            log(f"❌ ERROR CLIMA: {e}"); return
-
-        # --- AVISO MANUAL CALDERA ---
-        if es_invierno and temp_ext <= 1.0:
-            log("⚠️ AVISO: Temp baja detectada. Sugiriendo caldera a 73°C.")
-            await enviar_telegram(session, "⚠️ <b>ALERTA:</b> Menos de 1°C exterior. Sube la caldera a <b>73°C</b> manualmente.", temp_ext)
-
-        # --- MELCLOUD ---
-        token = await pymelcloud.login(EMAIL, PASSWORD, session)
-        devices = (await pymelcloud.get_devices(token, session)).get("ata", [])
-        await asyncio.gather(*(d.update() for d in devices))
-
-        await check_telegram_commands(session, registro, estados_previos, temp_ext, devices, es_invierno, en_horario)
-
-        for dev in devices:
-            temp_objetivo_actual = TEMP_OBJETIVOS.get(dev.name, DEFAULT_TEMP_AUTO)
-            # Recuperamos memoria
-            mem = estados_previos.get(dev.name, {"power": dev.power, "target_temperature": dev.target_temperature, "bloqueo_hasta": 0})
-
-            log(f"💠 {dev.name}: Estado={dev.power}, Temp={dev.target_temperature}°C | Obj={temp_objetivo_actual}°C")
-
-            # Gestión de Bloqueo Manual
-            if (mem["power"] != dev.power or mem["target_temperature"] != dev.target_temperature):
-                if ahora_ts > mem["bloqueo_hasta"]:
-                    log(f"    ✋ MANUAL DETECTADO en {dev.name}")
-                    await enviar_telegram(session, f"✋ <b>CAMBIO MANUAL:</b> {dev.name} a {dev.target_temperature}°C", temp_ext)
-                    mem["bloqueo_hasta"] = ahora_ts + DURACION_BLOQUEO_MANUAL
-            
-            # Actualizamos memoria con el estado actual del dispositivo antes de decidir
-            mem["power"], mem["target_temperature"] = dev.power, dev.target_temperature
-            estados_previos[dev.name] = mem
-
-            if mem["bloqueo_hasta"] > ahora_ts:
-                log(f"    ⏳ {dev.name} en bloqueo manual.")
-                continue
-
-            # --- MOTOR DE DECISIÓN ---
-            accion_tomada = None
-
-            if temp_ext < UMBRAL_SEGURIDAD_FRIO:
-                if dev.power:
-                    await dev.set({"power": False})
-                    mem["power"] = False
-                    accion_tomada = f"❄️ <b>SEGURIDAD:</b> Apagado {dev.name} por frío extremo"
-            
-            elif (not es_invierno) and (temp_ext < UMBRAL_CORTE_VERANO):
-                if dev.power:
-                    await dev.set({"power": False})
-                    mem["power"] = False
-                    accion_tomada = f"☀️ <b>FRESCO:</b> Apagado {dev.name}"
-
-            elif registro.get("stop_mode"):
-                if dev.power:
-                    await dev.set({"power": False})
-                    mem["power"] = False
-                    accion_tomada = f"🛑 <b>STOP:</b> Apagado {dev.name}"
-
-            else:
-                if es_invierno:
-                    if not en_horario:
-                        if dev.power:
-                            await dev.set({"power": False})
-                            mem["power"] = False
-                            accion_tomada = f"🕒 <b>NOCHE:</b> Apagado {dev.name}"
-                    elif en_horario and temp_ext <= UMBRAL_BUEN_TIEMPO_INVIERNO:
-                        # Si está apagado o la temperatura no es la correcta, actuamos
-                        if not dev.power or dev.target_temperature != temp_objetivo_actual:
-                            log(f"    🔥 Ajustando {dev.name} a {temp_objetivo_actual}°C")
-                            await dev.set({"power": True, "target_temperature": temp_objetivo_actual, "operation_mode": "heat"})
-                            mem["power"], mem["target_temperature"] = True, temp_objetivo_actual
-                            accion_tomada = f"🔥 <b>APOYO:</b> {dev.name} a {temp_objetivo_actual}°C"
-
-            if accion_tomada:
-                await enviar_telegram(session, accion_tomada, temp_ext)
-
-        # --- GUARDADO FINAL ---
-        save_json(STATE_FILE, estados_previos)
-        save_json(LAST_ACTION_FILE, registro)
-        guardar_resumen_csv(temp_ext, devices)
-        log("🏁 === FIN CICLO V8.3 ===")
+            # --- MELCLOUD ---
+            # get_devices no trae el estado de cada equipo (power, consigna...): update() sigue siendo necesario
+            try:
+                devices = await get_melcloud_devices(session)
+                await asyncio.gather(*(d.update() for d in devices))
+            except BaseException:
+                # No dejamos tareas huérfanas ("Task exception was never retrieved");
+                # weather_task la recoge aviso_task en el finally
+                updates_task.cancel()
+                await asyncio.gather(updates_task, return_exceptions=True)
+                raise
+
+            updates = await updates_task
+            try:
+                temp_ext = await weather_task
+            except Exception as e:
+                log(f"❌ ERROR CLIMA: {e}"); return
+
+            await check_telegram_commands(session, updates, registro, estados_previos, temp_ext, devices, es_invierno, en_horario)
+
+            resultados = await asyncio.gather(*(process_device(d, ahora_ts, temp_ext, registro, estados_previos, es_invierno, en_horario, queued) for d in devices))
+            for nombre, mem, _ in resultados:
+                estados_previos[nombre] = mem
+
+            # --- GUARDADO FINAL + AVISOS ---
+            # Escrituras en un hilo aparte para no bloquear el bucle de eventos con disco lento (SD/NFS),
+            # solapadas con los envíos a Telegram
+            tareas = [enviar_telegram(session, m, temp_ext) for m in queued]
+            queued.clear()
+            if firma(estados_previos) != firma_estados:
+                tareas.append(asyncio.to_thread(save_json, STATE_FILE, estados_previos))
+            if firma(registro) != firma_registro:
+                tareas.append(asyncio.to_thread(save_json, LAST_ACTION_FILE, registro))
+            tareas.append(asyncio.to_thread(guardar_resumen_csv, temp_ext, devices))
+            # return_exceptions: un fallo de disco no debe cortar los envíos pendientes a Telegram
+            for res in await asyncio.gather(*tareas, return_exceptions=True):
+                if isinstance(res, Exception):
+                    log(f"❌ ERROR GUARDADO FINAL: {res}")
+            log("🏁 === FIN CICLO V8.3 ===")
+        finally:
+            # Si el ciclo se corta a medias (p. ej. caída de MELCloud), los avisos ya generados salen igualmente
+            await asyncio.gather(aviso_task, *(enviar_telegram(session, m, temp_ext) for m in queued), return_exceptions=True)
         
 if __name__ == "__main__":
     async def run_safe():
         try: await main()
-        except Exception: log(f"❌ FATAL ERROR:\n{traceback.format_exc()}")
+        except Exception:
+            import traceback
+            log(f"❌ FATAL ERROR:\n{traceback.format_exc()}")
     asyncio.run(run_safe())